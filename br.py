@@ -5,17 +5,34 @@ this script monitors a folder and deletes the backup files after the
 retention days.
 
 the backup files require the date formatted as '_yyyy-MM-dd_' to be in the
-filename to be able to parse the date.
+filename to be able to parse the date. '_yyyyMMdd_' and '_epoch_' dates can be
+enabled with -f.
 """
 
+import os
+import re
 import sys
 import pathlib
+import time
 import logging
 import argparse
 import datetime
+import sqlite3
+import functools
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 
 
 DELETE_INDEX = 0
+BYTES_FREED = 0
+# max files handed to a single delete worker at a time.
+BATCH_SIZE = 256
+# date formats that can be found in a file name. the date has to be its own
+# '_' separated part of the name, e.g. 'server_2024-05-01_full.zip'.
+DATE_PATTERNS = {
+    'yyyy-MM-dd': r'(?P<dashed>\d{4}-\d{1,2}-\d{1,2})',
+    'yyyyMMdd': r'(?P<compact>\d{8})',
+    'epoch': r'(?P<epoch>\d{9,10})',
+}
 
 
 def arg_parser():
@@ -30,8 +47,20 @@ def arg_parser():
         help="Sets a day of the month to always keep (1-31).")
     parser.add_argument('-e', '--extension', required=False, action='append',
         help="The extension to look for. e.g. zip, tar, etc.")
+    parser.add_argument('-f', '--date-format', dest='date_format', action='append',
+        choices=DATE_PATTERNS.keys(),
+        help="An extra date format to look for in file names. yyyy-MM-dd is "
+        "always looked for.")
+    parser.add_argument('-p', '--prune-dirs', dest='prune_dirs', action='store_true',
+        help="Skips subdirectories whose name has a date that's within retention.")
+    parser.add_argument('-i', '--index', metavar='INDEX_PATH', type=pathlib.Path,
+        help="Keeps a file index at this path so later runs only rescan changed folders.")
+    parser.add_argument('--rebuild-index', dest='rebuild_index', action='store_true',
+        help="Throws away the --index and rebuilds it from scratch.")
     parser.add_argument('-l', '--log', required=False, metavar='LOG_PATH', type=pathlib.Path,
         help="The path to log to.")
+    parser.add_argument('-w', '--workers', default=8, type=int,
+        help="Sets how many threads to delete files with (%(default)s).")
     parser.add_argument('--dry-run', required=False, dest='dry_run', action='store_true',
         help="The path to log to.")
     parser.add_argument('-v', '--verbose', required=False, action='store_true',
@@ -77,27 +106,83 @@ def setup_log():
     
     return loggy
 
+def build_date_regex(formats):
+    """
+    Returns one compiled regex that matches any of the date formats, as long as
+    the date is bordered by '_' or the start/end of the name.
+    """
+    patterns = '|'.join(DATE_PATTERNS[f] for f in formats)
+    return re.compile(f'(?<![^_])(?:{patterns})(?![^_])')
+
+@functools.lru_cache(maxsize=4096)
+def token_to_date(kind, token):
+    """
+    Converts a matched date token to a date without strptime. backups share
+    just a handful of dates, so the results are cached per token.
+    """
+    if kind == 'dashed':
+        year, month, day = token.split('-')
+        return datetime.date(int(year), int(month), int(day))
+    if kind == 'compact':
+        return datetime.date(int(token[:4]), int(token[4:6]), int(token[6:]))
+    return datetime.date.fromtimestamp(int(token))
+
 def get_date(fn):
-    # split out the date
-    split_fn = fn.split('_')
-    # check each part of the file name for the date
-    for _ in split_fn:
+    # check each date shaped part of the file name, the first valid one wins
+    for match in DATE_RE.finditer(fn):
         try:
-            # convert the date to datetime
-            date = datetime.datetime.strptime(_, '%Y-%m-%d').date()
-            return date
-        except: continue
+            return token_to_date(match.lastgroup, match.group())
+        except (ValueError, OverflowError, OSError): continue
     return None
 
-def retain_or_delete(fp):
-    global DELETE_INDEX
+def in_retention(date):
+    """Returns True if the date is within the retention period."""
+    return datetime.date.today() - date < datetime.timedelta(days=ARGS.retention)
+
+def is_pruned(name):
+    """
+    Returns True if --prune-dirs is set and the folder name has a date that's
+    still within retention.
+    """
+    if not ARGS.prune_dirs:
+        return False
+    dir_date = get_date(name)
+    return dir_date is not None and in_retention(dir_date)
+
+def scan_backups(root, suffixes):
+    """
+    Walks the backup folder once and yields an os.DirEntry for every file that
+    ends with one of the suffixes.
     
-    fp_date = get_date(fp.name) # gets the date of the file
+    this replaces running rglob once per extension. os.scandir gets the file
+    type from the directory listing, so the walk doesn't need to stat every
+    file to tell files from folders.
+    """
+    dirs = [root]
+    while dirs:
+        current = dirs.pop()
+        try:
+            with os.scandir(current) as it:
+                for entry in it:
+                    if entry.is_dir(follow_symlinks=False):
+                        if is_pruned(entry.name):
+                            logg.debug(f"Within retention, pruning {entry.path}")
+                            continue
+                        dirs.append(entry.path)
+                    elif entry.name.endswith(suffixes):
+                        yield entry
+        except OSError as e:
+            logg.error(f"Error scanning {current}\n\t{e}")
+
+def retain_or_delete(entry):
+    """Returns True if the file is out of retention and should be deleted."""
+    fp = pathlib.Path(entry.path)
+    fp_date = get_date(entry.name) # gets the date of the file
     
     # if no date, continue to the next file
     if fp_date == None:
         logg.debug("Date not found in file, returning.")
-        return
+        return False
     
     # check if -k (keep) flag is in the arguments list
     # if it is, check if the current files date is the specified keep date
@@ -105,34 +190,257 @@ def retain_or_delete(fp):
     if ARGS.keep:
         if fp_date.day == ARGS.keep:
             logg.debug("Keep date found, skipping file.")
-            return
+            return False
     
     day_diff = datetime.date.today() - fp_date # difference between file date and today
     backup_retention = datetime.timedelta(days=ARGS.retention) # datetime retention
     
     if day_diff > backup_retention: # checks if the backup file is within retention or not
         # out of retention, delete
-        DELETE_INDEX += 1
-        # dry run, skip deleting.
-        if ARGS.dry_run is False: fp.unlink()
-        logg.info(f" * Deleted {fp}")
+        return True
     elif day_diff < backup_retention:
         # within retention, keep
         logg.debug("Within retention, skipping file.")
-        pass
     else:
         # something is wrong, retention is out of scope
         logg.error(f"Retention out of scope: {fp}")
+    return False
+
+def expired_files(entries):
+    """Checks retention on each entry and yields (path, size) if it's expired."""
+    for entry in entries:
+        try:
+            if not retain_or_delete(entry): continue
+            # the DirEntry caches its stat result, so this is the only stat
+            # call made on the file.
+            size = entry.stat(follow_symlinks=False).st_size
+        except Exception as e:
+            logg.error(f"Error running retention on {entry.path}\n\t{e}")
+            continue
+        yield entry.path, size
+
+def delete_batch(batch):
+    """
+    Deletes a batch of (path, size) files from the same folder and returns the
+    paths that are gone, how many files were deleted, and how many bytes were
+    freed. a failed unlink is logged and the rest of the batch keeps going.
+    """
+    gone = []
+    deleted = 0
+    freed = 0
+    for fp, size in batch:
+        try:
+            # dry run, skip deleting.
+            if ARGS.dry_run is False: os.unlink(fp)
+        except FileNotFoundError:
+            # deleted by hand since the index was updated, drop it from the
+            # index but don't count it.
+            logg.warning(f"Already deleted, removing stale entry {fp}")
+            gone.append(fp)
+            continue
+        except OSError as e:
+            logg.error(f"Error deleting {fp}\n\t{e}")
+            continue
+        gone.append(fp)
+        deleted += 1
+        freed += size
+        logg.info(f" * Deleted {fp}")
+    return gone, deleted, freed
+
+def delete_expired(files):
+    """
+    Deletes the expired (path, size) files on a pool of --workers threads and
+    returns the paths that are gone. the files are batched per folder, and
+    only a couple of batches per worker are queued at a time so the scan
+    doesn't get too far ahead of the deletes.
+    """
+    removed = []
+    
+    def collect(futures):
+        global DELETE_INDEX, BYTES_FREED
+        for future in futures:
+            gone, deleted, freed = future.result()
+            removed.extend(gone)
+            DELETE_INDEX += deleted
+            BYTES_FREED += freed
+    
+    pending = set()
+    batch = []
+    batch_dir = None
+    with ThreadPoolExecutor(max_workers=ARGS.workers) as pool:
+        for fp, size in files:
+            parent = os.path.dirname(fp)
+            if batch and (parent != batch_dir or len(batch) >= BATCH_SIZE):
+                pending.add(pool.submit(delete_batch, batch))
+                batch = []
+                if len(pending) >= ARGS.workers * 2:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    collect(done)
+            batch_dir = parent
+            batch.append((fp, size))
+        if batch:
+            pending.add(pool.submit(delete_batch, batch))
+        collect(pending)
+    return removed
+
+class RetentionIndex:
+    """
+    A sqlite index of the dated backup files and the folders they're in.
+    
+    each folder's mtime is saved, and a folder is only listed again when its
+    mtime changes. adding, removing, or renaming a file changes the folder's
+    mtime, so files deleted by hand are found and dropped from the index as
+    well. the expired files then come out of a single range query.
+    """
+    def __init__(self, index_path, root, suffixes, date_formats, rebuild=False):
+        self.root = str(root)
+        self.db = sqlite3.connect(index_path)
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+            CREATE TABLE IF NOT EXISTS dirs (
+                path TEXT PRIMARY KEY, parent TEXT, mtime INTEGER);
+            CREATE INDEX IF NOT EXISTS dirs_parent ON dirs (parent);
+            CREATE TABLE IF NOT EXISTS files (
+                path TEXT PRIMARY KEY, dir TEXT, date INTEGER,
+                size INTEGER, mtime INTEGER);
+            CREATE INDEX IF NOT EXISTS files_dir ON files (dir);
+            CREATE INDEX IF NOT EXISTS files_date ON files (date);
+        """)
+        # the index only holds what this root, extensions, and date formats
+        # matched, so rebuild it if any of them change.
+        meta = {
+            'root': self.root,
+            'suffixes': ' '.join(sorted(suffixes)),
+            'date_formats': ' '.join(sorted(date_formats)),
+        }
+        if dict(self.db.execute('SELECT key, value FROM meta')) != meta:
+            logg.info("Index settings changed, rebuilding.")
+            rebuild = True
+        if rebuild:
+            with self.db:
+                self.db.execute('DELETE FROM dirs')
+                self.db.execute('DELETE FROM files')
+                self.db.execute('DELETE FROM meta')
+                self.db.executemany('INSERT INTO meta VALUES (?, ?)', meta.items())
+    
+    def refresh(self, suffixes):
+        """Rescans the folders that changed since the last run."""
+        dirs = [(self.root, None)]
+        while dirs:
+            current, parent = dirs.pop()
+            if parent is not None and is_pruned(os.path.basename(current)):
+                logg.debug(f"Within retention, pruning {current}")
+                continue
+            try:
+                mtime = os.stat(current).st_mtime_ns
+            except FileNotFoundError:
+                self.forget_dir(current)
+                continue
+            except OSError as e:
+                logg.error(f"Error scanning {current}\n\t{e}")
+                continue
+            row = self.db.execute(
+                'SELECT mtime FROM dirs WHERE path = ?', (current,)).fetchone()
+            if row and row[0] == mtime:
+                # folder hasn't changed, its subfolders might have though.
+                dirs.extend(self.db.execute(
+                    'SELECT path, parent FROM dirs WHERE parent = ?', (current,)))
+                continue
+            try:
+                subdirs = self.scan_dir(current, parent, mtime, suffixes)
+            except OSError as e:
+                logg.error(f"Error scanning {current}\n\t{e}")
+                continue
+            dirs.extend((d, current) for d in subdirs)
+    
+    def scan_dir(self, current, parent, mtime, suffixes):
+        """Relists a folder, replaces its index entries, and returns its subfolders."""
+        logg.debug(f"Indexing {current}")
+        files = []
+        subdirs = []
+        with os.scandir(current) as it:
+            for entry in it:
+                if entry.is_dir(follow_symlinks=False):
+                    subdirs.append(entry.path)
+                elif entry.name.endswith(suffixes):
+                    fp_date = get_date(entry.name)
+                    if fp_date is None: continue
+                    st = entry.stat(follow_symlinks=False)
+                    files.append((entry.path, current, fp_date.toordinal(),
+                        st.st_size, st.st_mtime_ns))
+        # a folder changed in the last couple of seconds could change again
+        # within the same mtime tick, so don't trust its mtime next run.
+        if time.time_ns() - mtime < 2_000_000_000:
+            mtime = None
+        with self.db:
+            old_dirs = {r[0] for r in self.db.execute(
+                'SELECT path FROM dirs WHERE parent = ?', (current,))}
+            for gone in old_dirs.difference(subdirs):
+                self.forget_dir(gone)
+            self.db.execute('DELETE FROM files WHERE dir = ?', (current,))
+            self.db.executemany('INSERT INTO files VALUES (?, ?, ?, ?, ?)', files)
+            self.db.execute('INSERT OR REPLACE INTO dirs VALUES (?, ?, ?)',
+                (current, parent, mtime))
+            # new subfolders get a row with no mtime so they're scanned, and
+            # pruned subfolders are still remembered for when they expire.
+            self.db.executemany('INSERT OR IGNORE INTO dirs VALUES (?, ?, NULL)',
+                ((d, current) for d in subdirs))
+        return subdirs
+    
+    def forget_dir(self, path):
+        """Drops a folder and everything under it from the index."""
+        # '0' sorts right after '/', so this range is everything under path.
+        under = (f'{path}/', f'{path}0')
+        with self.db:
+            self.db.execute('DELETE FROM dirs WHERE path = ? OR (path >= ? AND path < ?)',
+                (path, *under))
+            self.db.execute('DELETE FROM files WHERE dir = ? OR (dir >= ? AND dir < ?)',
+                (path, *under))
+    
+    def expired_files(self):
+        """Yields (path, size) for each indexed file that's out of retention."""
+        cutoff = datetime.date.today() - datetime.timedelta(days=ARGS.retention)
+        rows = self.db.execute(
+            'SELECT path, size, date FROM files WHERE date < ? ORDER BY dir',
+            (cutoff.toordinal(),)).fetchall()
+        for fp, size, ordinal in rows:
+            # -k keep dates are kept no matter what.
+            if ARGS.keep and datetime.date.fromordinal(ordinal).day == ARGS.keep:
+                continue
+            yield fp, size
+    
+    def remove(self, paths):
+        """Removes deleted files from the index."""
+        with self.db:
+            self.db.executemany('DELETE FROM files WHERE path = ?',
+                ((fp,) for fp in paths))
+    
+    def close(self):
+        self.db.close()
 
 PARSER, ARGS = arg_parser()
 
 logg = setup_log()
 
+# yyyy-MM-dd is always looked for, -f only adds formats.
+DATE_FORMATS = list(dict.fromkeys(['yyyy-MM-dd'] + (ARGS.date_format or [])))
+DATE_RE = build_date_regex(DATE_FORMATS)
+
 if ARGS.retention < 0 or ARGS.retention > 31:
     PARSER.print_help
     print("Retention should be between 1 and 31.")
     sys.exit(1)
 
+if ARGS.workers < 1:
+    PARSER.print_help
+    print("Workers should be 1 or more.")
+    sys.exit(1)
+
+if ARGS.rebuild_index and not ARGS.index:
+    PARSER.print_help
+    print("--rebuild-index requires --index.")
+    sys.exit(1)
+
 if ARGS.dry_run:
     logg.info("Dry run is enabled, no files will be deleted.")
 
@@ -145,16 +453,27 @@ if not ARGS.backups_path.is_dir():
 try:
     logg.debug(f"Extension search: {ARGS.extension}")
     logg.debug(f"Backup retention days: {ARGS.retention}")
-    for ext in ARGS.extension:
-        for fp in ARGS.backups_path.rglob(f'*.{ext}'):
-            try:
-                retain_or_delete(fp)
-            except Exception as e:
-                logg.error(f"Error running retention on {fp}\n\t{e}")
+    logg.debug(f"Delete workers: {ARGS.workers}")
+    suffixes = tuple(f'.{ext}' for ext in ARGS.extension)
+    start_time = time.monotonic()
+    if ARGS.index:
+        index = RetentionIndex(ARGS.index.expanduser(), ARGS.backups_path,
+            suffixes, DATE_FORMATS, ARGS.rebuild_index)
+        index.refresh(suffixes)
+        removed = delete_expired(index.expired_files())
+        if ARGS.dry_run is False:
+            index.remove(removed)
+        index.close()
+    else:
+        delete_expired(expired_files(scan_backups(ARGS.backups_path, suffixes)))
+    run_time = time.monotonic() - start_time
 except Exception as err:
     logg.error(f"Generic file iteration error.\n\t{err}\nExiting...")
     sys.exit(1)
 
+logg.info(
+    f"Freed {BYTES_FREED / 1000000:.2f} MB in {run_time:.2f}s "
+    f"({DELETE_INDEX / max(run_time, 0.001):.1f} files/s).")
 logg.info(f"BR deleted {DELETE_INDEX} files. Fin.")
 
 # TODO: add -k date validation (1-31)
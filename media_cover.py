@@ -4,51 +4,134 @@
 This script recursively goes through a folder of mp4 and m4v files, extracts a
 PNG frame frame at the timestamp, and applies that as the video's cover.
 
+Videos that already have a cover are skipped unless --force is used.
+
 Requirements:
 
 - Progress Bar `pip install progress`
 - Mutagen `pip install mutagen`
 """
 
+import os
 import sys
+import struct
 import pathlib
+import argparse
 import subprocess
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from progress.bar import ChargingBar
 from mutagen.mp4 import MP4, MP4Cover
 
 
 FRAME_TIME_STAMP = '00:02:32'
+# how many videos to process at the same time.
+WORKERS = os.cpu_count() or 4
+VIDEO_SUFFIXES = ('.mp4', '.m4v')
+
+
+def arg_parser():
+    parser = argparse.ArgumentParser(
+        description="Sets a frame from each video as the video's cover.")
+    parser.add_argument('path', type=pathlib.Path,
+        help="The folder of mp4 and m4v files.")
+    parser.add_argument('-f', '--force', action='store_true',
+        help="Replaces covers on videos that already have one.")
+    return parser.parse_args()
+
+def find_box(fh, box_type, end):
+    """
+    Walks the MP4 box headers from the current position until end, and seeks
+    into the first box_type box. returns where that box ends, or None.
+    """
+    while fh.tell() + 8 <= end:
+        start = fh.tell()
+        size, found_type = struct.unpack('>I4s', fh.read(8))
+        if size == 1:
+            size = struct.unpack('>Q', fh.read(8))[0]
+        elif size == 0:
+            size = end - start
+        if size < 8:
+            return None
+        if found_type == box_type:
+            return start + size
+        fh.seek(start + size)
+    return None
 
+def has_cover(fp):
+    """
+    Checks for a covr atom by only reading box headers on the way to
+    moov/udta/meta/ilst, instead of loading the whole moov with mutagen.
+    """
+    try:
+        with open(fp, 'rb') as fh:
+            end = fh.seek(0, 2)
+            fh.seek(0)
+            for box_type in (b'moov', b'udta', b'meta'):
+                end = find_box(fh, box_type, end)
+                if end is None:
+                    return False
+            # meta is normally a full box with 4 bytes of version and flags.
+            if fh.read(4) != b'\x00\x00\x00\x00':
+                fh.seek(-4, 1)
+            end = find_box(fh, b'ilst', end)
+            return end is not None and find_box(fh, b'covr', end) is not None
+    except (OSError, struct.error):
+        return False
+
+def find_videos(folder):
+    """Yields the mp4 and m4v files as they're found."""
+    for fp in folder.rglob('*'):
+        if fp.suffix in VIDEO_SUFFIXES and fp.is_file():
+            yield fp
 
 def process_video(fp: pathlib.Path):
-    img_cmd = ['ffmpeg', '-y',
+    """Sets the video's cover, returns False if it was skipped."""
+    if not ARGS.force and has_cover(fp):
+        return False
+    # ffmpeg pipes the PNG frame to stdout so there's no temp file, which lets
+    # several videos be processed at the same time.
+    img_cmd = ['ffmpeg',
         '-ss', FRAME_TIME_STAMP,
         '-i', fp,
         '-frames:v', '1',
-        'thumb.png']
-    _ = subprocess.run(img_cmd, check=True, capture_output=True)
-    with open('thumb.png', 'rb') as fh:
-        video = MP4(fp)
-        video['covr'] = [MP4Cover(fh.read(), imageformat=MP4Cover.FORMAT_PNG)]
-        video.save()
+        '-f', 'image2pipe',
+        '-vcodec', 'png',
+        '-']
+    comp = subprocess.run(img_cmd, check=True, capture_output=True)
+    video = MP4(fp)
+    video['covr'] = [MP4Cover(comp.stdout, imageformat=MP4Cover.FORMAT_PNG)]
+    video.save()
+    return True
 
 def main():
-    file_list = list(FILES.rglob('*.mp4'))
-    file_list += list(FILES.rglob('*.m4v'))
+    # the bar's max is a running total of the videos found so far, so work
+    # starts on the first video instead of waiting for the whole file list.
     charge_bar = ChargingBar('Processing',
-        max=len(file_list),
+        max=0,
         suffix='%(index)s/%(max)s')
-    with charge_bar as bar:
-        for fp in file_list:
-            process_video(fp)
+    skipped = 0
+    
+    def collect(futures):
+        nonlocal skipped
+        for future in futures:
+            if future.result() is False:
+                skipped += 1
             bar.next()
+    
+    pending = set()
+    with charge_bar as bar, ThreadPoolExecutor(max_workers=WORKERS) as pool:
+        for fp in find_videos(FILES):
+            bar.max += 1
+            pending.add(pool.submit(process_video, fp))
+            if len(pending) >= WORKERS * 2:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                collect(done)
+        collect(pending)
+    print(f"Covered {bar.index - skipped} videos, skipped {skipped} that already had a cover.")
 
 
-if sys.argv[-1] == __file__:
-    print("Please provide a file path.")
-    sys.exit(1)
-
-FILES = pathlib.Path(sys.argv[-1])
+ARGS = arg_parser()
+FILES = ARGS.path
 
 if FILES.exists() is False:
     print("Folder path doesn't exist.")
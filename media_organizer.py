@@ -6,18 +6,44 @@ structure for it if needed, and then move the video file into that appropriate
 folder.
 """
 
+import os
 import re
+import time
 import json
+import struct
 import shutil
 import logging
+import threading
+import errno
 import pathlib
 import argparse
 import subprocess
 from datetime import datetime
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
 
 TV_DST = '/path/to/tv/root'
 MOVIE_DST = '/path/to/movie/root'
+# only files with these extensions can have the media_type tag, so everything
+# else is skipped without running ffprobe.
+MEDIA_SUFFIXES = ('.mp4', '.m4v', '.mov')
+# cross device copies are done in chunks this size (in bytes).
+COPY_CHUNK = 64 * 1024 * 1024
+PROBE_CACHE = '~/Library/Caches/media_organizer_probe_cache.json'
+# iTunes ilst atoms that are read without ffprobe, mapped to the tag name that
+# ffprobe gives them.
+ILST_TAGS = {
+    b'stik': 'media_type',
+    b'\xa9nam': 'title',
+    b'\xa9ART': 'artist',
+    b'aART': 'album_artist',
+    b'\xa9day': 'date',
+    b'tvsh': 'show',
+    b'tvsn': 'season_number',
+    b'tves': 'episode_sort',
+    b'trkn': 'track',
+}
 
 
 def arg_parser():
@@ -28,6 +54,20 @@ def arg_parser():
         help="Doesn't copy any files.")
     parser.add_argument('-d', '--destination', type=pathlib.Path, required=False,
         help="Overrides the destination path the file will be moved to.")
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+        help="How many files to probe at the same time (%(default)s).")
+    parser.add_argument('--copy-workers', dest='copy_workers', type=int, default=2,
+        help="How many files to copy at the same time across devices (%(default)s).")
+    parser.add_argument('--ffprobe', dest='force_ffprobe', action='store_true',
+        help="Always reads tags with ffprobe instead of reading the MP4 atoms.")
+    parser.add_argument('--cache', type=pathlib.Path, default=PROBE_CACHE,
+        help="Where to save the tag cache (%(default)s).")
+    parser.add_argument('--cache-size', dest='cache_size', type=int, default=20000,
+        help="How many files to keep in the tag cache (%(default)s).")
+    parser.add_argument('--no-cache', dest='no_cache', action='store_true',
+        help="Always reads the file tags, ignoring the tag cache.")
+    parser.add_argument('--cache-stats', dest='cache_stats', action='store_true',
+        help="Prints the tag cache hit rate when finished.")
     parser.add_argument('--log', action='store_true', required=False,
         help="Saves output to a log file.")
     parser.add_argument('-v', '--verbose', action='count', default=0,
@@ -95,6 +135,262 @@ def ffprobe(fp):
     tag_data = json.loads(comp.stdout)
     return tag_data.get('format', {}).get('tags')
 
+def read_box_header(fh, end):
+    """
+    Reads an MP4 box header at the current position and returns the box type
+    and where the box ends. returns None at the end of the parent box.
+    """
+    start = fh.tell()
+    if start + 8 > end:
+        return None
+    header = fh.read(8)
+    if len(header) < 8:
+        raise ValueError("Truncated box header.")
+    size, box_type = struct.unpack('>I4s', header)
+    if size == 1:
+        # 64-bit box size follows the type.
+        size = struct.unpack('>Q', fh.read(8))[0]
+    elif size == 0:
+        # box runs to the end of the parent (or file).
+        size = end - start
+    if size < 8 or start + size > end:
+        raise ValueError(f"Bad box size for {box_type}.")
+    return box_type, start + size
+
+def find_box(fh, box_type, end):
+    """Seeks into the first box_type box before end and returns where it ends."""
+    while True:
+        header = read_box_header(fh, end)
+        if header is None:
+            return None
+        found_type, box_end = header
+        if found_type == box_type:
+            return box_end
+        fh.seek(box_end)
+
+def read_ilst_value(name, data_type, value):
+    """Converts an ilst data value into the string ffprobe would return."""
+    if name == 'track':
+        # trkn is 2 bytes padding, track number, track total, 2 bytes padding
+        track, total = struct.unpack('>HH', value[2:6])
+        return f"{track}/{total}" if total else str(track)
+    if data_type == 1:
+        return value.decode('utf-8')
+    if data_type == 21 and len(value) in (1, 2, 4, 8):
+        return str(int.from_bytes(value, 'big', signed=True))
+    raise ValueError(f"Unhandled data type {data_type} for {name}.")
+
+def read_mp4_tags(fp):
+    """
+    Reads the iTunes tags straight out of an MP4's moov/udta/meta/ilst atom,
+    returning the same tag dict as ffprobe(). only the box headers on the way
+    to ilst and the wanted ilst items are read, so a whole file takes a
+    handful of small reads. raises ValueError if the file isn't laid out as
+    expected.
+    """
+    with open(fp, 'rb') as fh:
+        file_end = fh.seek(0, 2)
+        fh.seek(0)
+        end = file_end
+        for box_type in (b'moov', b'udta', b'meta'):
+            end = find_box(fh, box_type, end)
+            if end is None:
+                if box_type == b'moov':
+                    raise ValueError("No moov box found.")
+                return {}
+        # meta is normally a full box with 4 bytes of version and flags, but
+        # quicktime files write it as a plain container.
+        if fh.read(4) != b'\x00\x00\x00\x00':
+            fh.seek(-4, 1)
+        end = find_box(fh, b'ilst', end)
+        if end is None:
+            return {}
+        tags = {}
+        while True:
+            header = read_box_header(fh, end)
+            if header is None:
+                return tags
+            item_type, item_end = header
+            name = ILST_TAGS.get(item_type)
+            if name:
+                data_end = find_box(fh, b'data', item_end)
+                if data_end is not None:
+                    # data box is 4 bytes of type and 4 bytes of locale
+                    data_type = struct.unpack('>I', fh.read(8)[:4])[0] & 0xffffff
+                    value = fh.read(data_end - fh.tell())
+                    tags[name] = read_ilst_value(name, data_type, value)
+            fh.seek(item_end)
+
+def read_tags(fp):
+    """Reads fp's tags from the MP4 atoms, falling back to ffprobe."""
+    if not ARGS.force_ffprobe:
+        try:
+            return read_mp4_tags(fp)
+        except (OSError, ValueError, struct.error) as e:
+            logg.debug(f"Couldn't read MP4 atoms, using ffprobe. {e}\n\t{fp}")
+    return ffprobe(fp)
+
+class ProbeCache:
+    """
+    A persistent LRU cache of file tags.
+    
+    files that can't be sorted stay in the source folder and get probed again
+    every run. the cache key is the file's device, inode, size, and mtime, so
+    an unchanged file isn't read again and a changed file is probed again. the
+    least recently used entries are dropped once there are more than max_size.
+    """
+    def __init__(self, cache_path, max_size):
+        self.cache_path = cache_path.expanduser()
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.entries = {}
+        if self.cache_path.is_file():
+            try:
+                with open(self.cache_path, 'r') as fh:
+                    self.entries = json.load(fh)
+            except (OSError, ValueError) as e:
+                logg.warning(f"Couldn't read the tag cache, starting fresh.\n\t{e}")
+    
+    @staticmethod
+    def key(fp):
+        st = fp.stat()
+        return f"{st.st_dev}:{st.st_ino}:{st.st_size}:{st.st_mtime_ns}"
+    
+    def probe(self, fp):
+        """Returns fp's tags from the cache, reading the file on a miss."""
+        key = self.key(fp)
+        with self.lock:
+            if key in self.entries:
+                self.hits += 1
+                # move the entry to the end so it's the most recently used.
+                tags = self.entries.pop(key)
+                self.entries[key] = tags
+                return tags
+            self.misses += 1
+        tags = read_tags(fp)
+        with self.lock:
+            self.entries[key] = tags
+            while len(self.entries) > self.max_size:
+                # dicts keep insertion order, so the first key is the oldest.
+                del self.entries[next(iter(self.entries))]
+        return tags
+    
+    def save(self):
+        self.cache_path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.cache_path.with_suffix('.tmp')
+        with open(tmp_path, 'w') as fh:
+            json.dump(self.entries, fh)
+        tmp_path.replace(self.cache_path)
+    
+    def stats(self):
+        total = self.hits + self.misses
+        rate = self.hits / total * 100 if total else 0
+        return (f"Tag cache: {self.hits}/{total} hits ({rate:.1f}%), "
+            f"{len(self.entries)} entries")
+
+class MoveEngine:
+    """
+    Moves files into the media folders.
+    
+    a file on the same device as its destination is renamed in place. a file
+    on another device is copied on a small pool of workers to a temporary
+    file next to the destination, its size is verified, and it's renamed into
+    place. the source is only deleted after all of that worked.
+    """
+    def __init__(self, workers):
+        self.pool = ThreadPoolExecutor(max_workers=workers)
+        self.futures = []
+        self.lock = threading.Lock()
+        self.renamed = 0
+        self.copied = 0
+        self.copied_bytes = 0
+        self.failed = 0
+        # set when the first copy is submitted, so MB/s only covers copying.
+        self.copy_start = None
+    
+    def move(self, fp, dst_fp):
+        if os.stat(fp).st_dev == os.stat(dst_fp.parent).st_dev:
+            try:
+                os.rename(fp, dst_fp)
+                self.renamed += 1
+                return
+            except OSError as e:
+                # bind mounts and some network shares share a device but
+                # still can't rename across, so copy those instead.
+                if e.errno != errno.EXDEV: raise
+        if self.copy_start is None:
+            self.copy_start = time.monotonic()
+        self.futures.append(self.pool.submit(self.copy_move, fp, dst_fp))
+    
+    def copy_move(self, fp, dst_fp):
+        tmp_fp = dst_fp.with_name(f".{dst_fp.name}.part")
+        try:
+            size = os.stat(fp).st_size
+            self.copy_file(fp, tmp_fp, size)
+            copied_size = os.stat(tmp_fp).st_size
+            if copied_size != size:
+                raise OSError(f"Copied {copied_size} of {size} bytes.")
+            shutil.copystat(fp, tmp_fp)
+            os.replace(tmp_fp, dst_fp)
+        except OSError as e:
+            logg.error(f"Error copying {fp}, leaving it in place.\n\t{e}")
+            tmp_fp.unlink(missing_ok=True)
+            with self.lock:
+                self.failed += 1
+            return
+        try:
+            os.unlink(fp)
+        except OSError as e:
+            logg.error(f"Copied {fp} but couldn't delete it, it's now in "
+                f"both places.\n\t{e}")
+            with self.lock:
+                self.failed += 1
+            return
+        with self.lock:
+            self.copied += 1
+            self.copied_bytes += size
+    
+    def copy_file(self, fp, dst_fp, size):
+        """
+        Copies fp to dst_fp in COPY_CHUNK sized chunks with copy_file_range
+        where the OS has it, falling back to shutil.copyfile (which uses
+        sendfile or fcopyfile) when it doesn't.
+        """
+        copied = 0
+        with open(fp, 'rb') as fsrc, open(dst_fp, 'wb') as fdst:
+            if hasattr(os, 'copy_file_range'):
+                try:
+                    while copied < size:
+                        sent = os.copy_file_range(fsrc.fileno(), fdst.fileno(),
+                            min(COPY_CHUNK, size - copied))
+                        if sent == 0: break
+                        copied += sent
+                        if ARGS.verbose > 0 and copied % (16 * COPY_CHUNK) < sent:
+                            logg.info(f"Copied {copied // 1000000}/{size // 1000000} MB of {fp.name}")
+                except OSError as e:
+                    # not supported between these filesystems, copy normally.
+                    if copied: raise
+                    logg.debug(f"copy_file_range failed, falling back. {e}")
+            if copied == 0:
+                fdst.close()
+                shutil.copyfile(fp, dst_fp)
+                return
+            os.fsync(fdst.fileno())
+    
+    def finish(self):
+        """Waits for the copies to finish and logs the move stats."""
+        self.pool.shutdown(wait=True)
+        for future in self.futures:
+            future.result()
+        copy_start = self.copy_start or time.monotonic()
+        copy_time = max(time.monotonic() - copy_start, 0.001)
+        logg.info(f"Renamed {self.renamed} files, copied {self.copied} files "
+            f"({self.copied_bytes / 1000000:.1f} MB at "
+            f"{self.copied_bytes / 1000000 / copy_time:.1f} MB/s), "
+            f"{self.failed} failed.")
+
 def build_movie_path(tags, suffix):
     title = tags.get('title')
     release_date = tags.get('date')
@@ -149,12 +445,37 @@ def build_tv_path(tags, suffix):
             ARGS.destination, show, f'Season {season_no}', file_name).expanduser()
     return pathlib.Path(TV_DST, show, f'Season {season_no}', file_name).expanduser()
 
-def main():
-    for fp in ARGS.source.rglob('*'):
+def media_files(source):
+    """Yields the files in source that could be tagged media files."""
+    for fp in source.rglob('*'):
+        if fp.suffix.lower() not in MEDIA_SUFFIXES: continue
         # skip any directories
         if fp.is_dir(): continue
-        
-        tags = ffprobe(fp)
+        yield fp
+
+def probe_files(files):
+    """
+    Yields (fp, tags) for each file, probing up to --jobs files at a time.
+    results are yielded in the same order as the files so moves stay the same
+    as a serial run, and only a couple of probes per job are queued ahead.
+    """
+    probe = CACHE.probe if CACHE else read_tags
+    queue = deque()
+    with ThreadPoolExecutor(max_workers=ARGS.jobs) as pool:
+        for fp in files:
+            queue.append((fp, pool.submit(probe, fp)))
+            if len(queue) >= ARGS.jobs * 2:
+                fp, future = queue.popleft()
+                yield fp, future.result()
+        while queue:
+            fp, future = queue.popleft()
+            yield fp, future.result()
+
+def main():
+    # destinations used this run, this catches two files that map to the same
+    # destination when it's a dry run and the first file wasn't moved.
+    claimed = set()
+    for fp, tags in probe_files(media_files(ARGS.source)):
         if tags is None:
             logg.debug(f"No tags found, probably not a media file.\n\t{fp}")
             continue
@@ -168,12 +489,20 @@ def main():
         elif media_type == '10':
             # tv show type
             dst_fp = build_tv_path(tags, fp.suffix)
+        else:
+            logg.debug(f"Unknown media type {media_type}, skipping.\n\t{fp}")
+            continue
         
         # the script wasn't able to build a file path, give a file name and skip.
         if dst_fp is None:
             logg.warning(f'\t{fp}')
             continue
         
+        if dst_fp in claimed:
+            logg.warning(f"File already exists, skipping {fp}...")
+            continue
+        claimed.add(dst_fp)
+        
         if DRY_RUN:
             if not dst_fp.parent.exists:
                 logg.info(f"Creating folder path: {str(dst_fp.parent)}")
@@ -185,7 +514,7 @@ def main():
             if dst_fp.exists():
                 logg.warning(f"File already exists, skipping {fp}...")
                 continue
-            shutil.move(fp, dst_fp)
+            MOVER.move(fp, dst_fp)
         
         if ARGS.verbose > 0 or DRY_RUN is True:
             logg.info(f"Moved\n\t{fp}\n\tto {dst_fp}")
@@ -194,6 +523,22 @@ if __name__ == '__main__':
     ARGS = arg_parser()
     logg = setup_log()
     DRY_RUN = ARGS.dry_run
+    if ARGS.jobs < 1:
+        logg.error("--jobs should be 1 or more.")
+        exit(1)
     if DRY_RUN or ARGS.verbose > 0:
         logg.info(f"Dry run: {DRY_RUN}")
-    main()
+    if ARGS.copy_workers < 1:
+        logg.error("--copy-workers should be 1 or more.")
+        exit(1)
+    CACHE = None if ARGS.no_cache else ProbeCache(ARGS.cache, ARGS.cache_size)
+    MOVER = MoveEngine(ARGS.copy_workers)
+    try:
+        main()
+        if not DRY_RUN:
+            MOVER.finish()
+    finally:
+        if CACHE:
+            CACHE.save()
+            if ARGS.cache_stats:
+                logg.info(CACHE.stats())
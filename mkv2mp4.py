@@ -1,14 +1,32 @@
 #!/usr/bin/env python3
+import os
 import sys
+import json
+import hashlib
+import shutil
 import pathlib
 import argparse
+import tempfile
+import threading
+import functools
 import subprocess
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, wait
 
 
-__version__ = '1.0.0'
+__version__ = '1.2.0'
+
+JOURNAL_NAME = '.mkv2mp4_journal.jsonl'
+
+# conversion progress for the running jobs, {source path: 0.0-1.0}
+PROGRESS = {}
+PROGRESS_LOCK = threading.Lock()
+
+# a probed stream. type_index is the stream's index within its codec type,
+# e.g. the second audio stream is 0:a:1.
+Stream = namedtuple('Stream', ['index', 'codec_type', 'codec_name', 'type_index'])
 
 # TODO: expand verbosity
-# TODO: implement flat directory scan
 # TODO: implement extension input (-e, --extension?)
 
 
@@ -21,89 +39,287 @@ def arg_parser():
     parser.add_argument('-D', '--directory-flat', dest='directory_flat',
         type=pathlib.Path,
         help="A directory path with MKV's to convert (not recursive).")
+    parser.add_argument('-j', '--jobs', type=int,
+        help="How many files to convert at the same time (default is based on the cores and disk type).")
     parser.add_argument('-y', '--yes', required=False, action='store_true',
-        help="Overwrites output files without asking.")
+        help="Overwrites output files, otherwise existing outputs are skipped. Files the journal has as converted are always skipped.")
+    parser.add_argument('--no-journal', dest='no_journal', action='store_true',
+        help=f"Doesn't read or write the {JOURNAL_NAME} conversion journal.")
+    parser.add_argument('--dry-run', dest='dry_run', action='store_true',
+        help="Prints the ffmpeg commands without converting anything.")
     parser.add_argument('-V', '--version', required=False, action='store_true',
         help="Prints the version.")
     parser.add_argument('-v', '--verbose', required=False, action='store_true',
         help="Verbose output.")
     return parser, parser.parse_args()
 
+class Journal:
+    """
+    A JSON lines journal of probed and converted files, saved in the root
+    folder.
+    
+    each line is a record for a source file's path, size, and mtime, and the
+    last line for a path wins. records keep the probed streams so a rerun
+    doesn't probe again, and a 'done' status with the output's size once the
+    output has been renamed into place. anything else (probed, failed, or a
+    run that was cut off) gets converted again.
+    """
+    def __init__(self, journal_path):
+        self.journal_path = journal_path
+        self.lock = threading.Lock()
+        self.records = {}
+        if journal_path.is_file():
+            with open(journal_path, 'r') as fh:
+                for line in fh:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # a line cut off by an interrupted run
+                        continue
+                    self.records[record['src']] = record
+        self.fh = open(journal_path, 'a')
+    
+    def get(self, mkv, st):
+        """Returns mkv's record if the file hasn't changed since it was written."""
+        record = self.records.get(str(mkv))
+        if record and record['size'] == st.st_size and record['mtime'] == st.st_mtime_ns:
+            return record
+        return None
+    
+    def is_done(self, mkv):
+        record = self.get(mkv, os.stat(mkv))
+        if not record or record.get('status') != 'done':
+            return False
+        try:
+            return os.stat(out_path(mkv)).st_size == record['out_size']
+        except OSError:
+            return False
+    
+    def record(self, mkv, **fields):
+        """Updates mkv's record with the fields and appends it to the journal."""
+        st = os.stat(mkv)
+        with self.lock:
+            record = dict(self.get(mkv, st) or {})
+            record.update(fields, src=str(mkv), size=st.st_size, mtime=st.st_mtime_ns)
+            self.records[str(mkv)] = record
+            self.fh.write(json.dumps(record) + '\n')
+            self.fh.flush()
+    
+    def close(self):
+        """Rewrites the journal with only the latest record for each file."""
+        self.fh.close()
+        tmp_path = self.journal_path.with_suffix('.tmp')
+        with open(tmp_path, 'w') as fh:
+            for record in self.records.values():
+                fh.write(json.dumps(record) + '\n')
+        os.replace(tmp_path, self.journal_path)
+
 def probe(path):
-    videos = []
-    audios = []
-    subtitles = []
+    """
+    Probes the file's streams with one ffprobe JSON call and returns a list of
+    Streams and the duration in seconds. results are cached per file path,
+    size, and mtime, in memory and in the journal, so a file is only probed
+    once.
+    """
+    st = os.stat(path)
+    record = JOURNAL.get(path, st) if JOURNAL else None
+    if record and 'streams' in record:
+        return [Stream(*s) for s in record['streams']], record['duration']
+    streams, duration = _probe(str(path), st.st_size, st.st_mtime_ns)
+    if JOURNAL:
+        JOURNAL.record(path, status='probed', streams=streams, duration=duration)
+    return streams, duration
+
+@functools.lru_cache(maxsize=None)
+def _probe(path, size, mtime):
+    task = subprocess.run(['ffprobe', '-v', 'error',
+        '-show_streams', '-show_format', '-of', 'json', path],
+        capture_output=True, check=True)
+    probe_data = json.loads(task.stdout)
+    streams = []
+    type_counts = {}
+    for stream_data in probe_data.get('streams', []):
+        codec_type = stream_data.get('codec_type')
+        type_index = type_counts.get(codec_type, 0)
+        type_counts[codec_type] = type_index + 1
+        streams.append(Stream(stream_data.get('index'), codec_type,
+            stream_data.get('codec_name', ''), type_index))
+    try:
+        duration = float(probe_data['format']['duration'])
+    except (KeyError, ValueError):
+        duration = None
+    return streams, duration
+
+def build_cmd(path, streams):
+    """Builds the ffmpeg command from the probed streams."""
+    # base command. the streams are copied, not encoded, so ffmpeg doesn't need
+    # a thread count. ffmpeg writes to a temp file that's always overwritten,
+    # existing outputs are checked before converting.
+    cmd = ['ffmpeg', '-nostdin', '-loglevel', 'error', '-y',
+        '-i', path, '-c:v', 'copy']
+    video_map = []
+    audio_map = []
+    sub_map = []
+    sub_codecs = []
+    # can't convert TrueHD audio by default, flag it
     has_truehd = False
+    # subrips can be convert to mov_text for MP4s, need to add more
+    # convertable formats as needed.
     incompatible_subs = False
-    # base command
-    cmd = ['ffmpeg', '-threads', '24', '-i', path, '-c:v', 'copy']
-    # insert yes, overwrite, command.
-    if ARGS.yes:
-        cmd.insert(3, '-y')
-    # check video input for how it should be converted.
-    task = subprocess.run(['ffprobe', '-i', path], capture_output=True, check=True)
-    probe_lines = task.stderr.decode('utf-8').splitlines()
-    for l in probe_lines:
-        if 'stream' not in l.lower(): continue
-        if 'Video' in l:
-            videos.append(l)
-        elif 'Audio' in l:
-            # can't convert TrueHD audio by default, flag it
-            if 'truehd' in l.lower():
+    for stream in streams:
+        if stream.codec_type == 'video':
+            video_map += ['-map', f'0:v:{stream.type_index}']
+        elif stream.codec_type == 'audio':
+            if stream.codec_name == 'truehd':
                 has_truehd = True
-            audios.append(l)
-        elif 'Subtitle' in l:
-            # subrips can be convert to mov_text for MP4s, need to add more
-            # convertable formats as needed.
-            if 'subrip' not in l.lower():
+            audio_map += ['-map', f'0:a:{stream.type_index}']
+        elif stream.codec_type == 'subtitle':
+            # skip non subrips because they can't be converted to mov_text
+            if stream.codec_name != 'subrip':
                 incompatible_subs = True
-            subtitles.append(l)
+                continue
+            # the codec flag uses the output index, which only counts the
+            # subtitles that are mapped.
+            sub_codecs += [f'-c:s:{len(sub_map) // 2}', 'mov_text']
+            sub_map += ['-map', f'0:s:{stream.type_index}']
     if has_truehd:
         # -strcit -2 allows ffmpeg to use TrueHD audio in an mp4
         # add this (if needed) before the audio copy flags
-        cmd = cmd + ['-strict', '-2']
-    cmd = cmd + ['-c:a', 'copy']
-    sub_map = []
-    for sub in subtitles:
-        # skip non subrips because they can't be converted to mov_text
-        if 'subrip' not in sub.lower(): continue
-        # if it can be converted, get the subtitle index, and add the flags to
-        # convert and map it if there are incompatible subs in the file.
-        idex = subtitles.index(sub)
-        if incompatible_subs:
-            cmd = cmd + [f'-c:s:{idex}', 'mov_text']
-        else:
-            # if there aren't any incompatible subs, add the flags to convert
-            # all the subs
-            cmd = cmd + ['-c:s', 'mov_text']
-            break
-        sub_map = sub_map + ['-map', f'0:s:{idex}']
-    # return the cmd without adding extra maps
-    if incompatible_subs is False: return cmd
+        cmd += ['-strict', '-2']
+    cmd += ['-c:a', 'copy']
+    # if there aren't any incompatible subs, convert all the subs and let
+    # ffmpeg pick the streams.
+    if incompatible_subs is False:
+        if sub_codecs:
+            cmd += ['-c:s', 'mov_text']
+        return cmd
     # if required, map the video, audio, and subtitles; and then return the cmd.
-    for idex, _ in enumerate(videos):
-        cmd = cmd + ['-map', f'0:v:{idex}']
-    for idex, _ in enumerate(audios):
-        cmd = cmd + ['-map', f'0:a:{idex}']
-    if sub_map:
-        cmd = cmd + sub_map
-    return cmd
-
-def convert(mkv, cmd):
-    file_name = mkv.stem
-    out_file = ROOT_DIR / f"{file_name}.mp4"
-    cmd.append(out_file)
-    task = subprocess.Popen(cmd, stdout=subprocess.PIPE)
-    while task.poll() is None:
-        output = task.stdout.readline()
-        if output:
-            print(output)
+    return cmd + sub_codecs + video_map + audio_map + sub_map
+
+def out_path(mkv):
+    return ROOT_DIR / f"{mkv.stem}.mp4"
+
+def convert(mkv, cmd, duration):
+    """
+    Runs the ffmpeg cmd, reading its -progress output to update PROGRESS.
+    ffmpeg writes to a hidden temp file that's renamed to the output once it
+    finishes, so an output is never a partial file. returns ffmpeg's return
+    code and any error output.
+    """
+    final_fp = out_path(mkv)
+    # named after the full source path so two sources can't share a temp file
+    src_hash = hashlib.sha1(str(mkv).encode('utf-8')).hexdigest()[:8]
+    tmp_fp = final_fp.with_name(f".{final_fp.stem}.{src_hash}.partial.mp4")
+    cmd = cmd + ['-progress', 'pipe:1', '-nostats', tmp_fp]
+    with PROGRESS_LOCK:
+        PROGRESS[mkv] = 0.0
+    # errors go to a temp file so a chatty ffmpeg can't fill the stderr pipe
+    with tempfile.TemporaryFile() as err_fh:
+        task = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=err_fh,
+            stdin=subprocess.DEVNULL, text=True)
+        for line in task.stdout:
+            key, _, value = line.strip().partition('=')
+            if key != 'out_time_us' or not duration: continue
+            try:
+                done = min(int(value) / 1000000 / duration, 1.0)
+            except ValueError: continue
+            with PROGRESS_LOCK:
+                PROGRESS[mkv] = done
+        task.wait()
+        err_fh.seek(0)
+        errors = err_fh.read().decode('utf-8', errors='replace').strip()
+    with PROGRESS_LOCK:
+        del PROGRESS[mkv]
+    if task.returncode == 0:
+        os.replace(tmp_fp, final_fp)
+        if JOURNAL:
+            JOURNAL.record(mkv, status='done', out_size=os.stat(final_fp).st_size)
+    else:
+        tmp_fp.unlink(missing_ok=True)
+        if JOURNAL:
+            JOURNAL.record(mkv, status='failed')
+    return task.returncode, errors
+
+def is_rotational(path):
+    """
+    Returns True if path is on a spinning disk, False if it's on an SSD, and
+    None if that can't be found (only Linux exposes it).
+    """
+    dev = os.stat(path).st_dev
+    sys_dev = pathlib.Path(f'/sys/dev/block/{os.major(dev)}:{os.minor(dev)}')
+    # partitions don't have a queue folder, their parent disk does.
+    for queue in (sys_dev / 'queue', sys_dev / '..' / 'queue'):
+        try:
+            return (queue / 'rotational').read_text().strip() == '1'
+        except OSError: continue
+    return None
+
+def default_jobs(path):
+    """
+    Picks how many files to convert at once. remuxing is I/O bound, so this is
+    set by the disk more than the cores: a spinning disk slows down with more
+    than a couple of readers, an SSD can keep a few more jobs busy.
+    """
+    cores = os.cpu_count() or 1
+    if is_rotational(path) is False:
+        return min(4, cores)
+    return min(2, cores)
+
+def show_progress(futures):
+    """Prints one combined progress line until all the conversions finish."""
+    total = len(futures)
+    finished = 0
+    failed = 0
+    pending = set(futures)
+    while pending:
+        done, pending = wait(pending, timeout=0.5)
+        for future in done:
+            mkv = futures[future]
+            finished += 1
+            return_code, errors = future.result()
+            # clear the progress line before printing the result
+            print('\r\033[K', end='')
+            if return_code == 0:
+                print(f"Converted {mkv}")
+            else:
+                failed += 1
+                print(f"Failed to convert {mkv} ({return_code})\n\t{errors}")
+        with PROGRESS_LOCK:
+            running = ' | '.join(f"{mkv.name} {pct:.0%}" for mkv, pct in PROGRESS.items())
+        status = f"[{finished}/{total}] {running}"
+        width = shutil.get_terminal_size().columns - 1
+        print(f"\r\033[K{status[:width]}", end='', flush=True)
+    print()
+    print(f"Converted {finished - failed}/{total} files.")
 
 def main():
-    for mkv in MKV_FILES:
-        cmd = probe(mkv)
-        if ARGS.verbose: print(cmd)
-        convert(mkv, cmd)
+    jobs = ARGS.jobs or default_jobs(ROOT_DIR)
+    if ARGS.verbose: print(f"Converting {jobs} files at a time.")
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        futures = {}
+        # outputs already taken by a file in this run. -d flattens every
+        # subfolder into ROOT_DIR, so Disc1/title_t00.mkv and
+        # Disc2/title_t00.mkv would both write title_t00.mp4.
+        claimed = set()
+        for mkv in MKV_FILES:
+            if JOURNAL and JOURNAL.is_done(mkv):
+                if ARGS.verbose: print(f"{mkv} already converted, skipping.")
+                claimed.add(out_path(mkv))
+                continue
+            if out_path(mkv).exists() and not ARGS.yes:
+                print(f"{out_path(mkv)} already exists, skipping (use -y to overwrite).")
+                continue
+            if out_path(mkv) in claimed:
+                print(f"{mkv} would also convert to {out_path(mkv)}, skipping.")
+                continue
+            claimed.add(out_path(mkv))
+            streams, duration = probe(mkv)
+            cmd = build_cmd(mkv, streams)
+            if ARGS.verbose or ARGS.dry_run: print(cmd)
+            if ARGS.dry_run: continue
+            futures[pool.submit(convert, mkv, cmd, duration)] = mkv
+        if not ARGS.dry_run:
+            show_progress(futures)
 
 if __name__ == '__main__':
     PARSER, ARGS = arg_parser()
@@ -112,6 +328,11 @@ if __name__ == '__main__':
         print(f"v{__version__}")
         sys.exit(0)
     
+    if ARGS.jobs is not None and ARGS.jobs < 1:
+        PARSER.print_help()
+        print("\n--jobs should be 1 or more.\n")
+        sys.exit(1)
+    
     if not ARGS.file and not ARGS.directory and not ARGS.directory_flat:
         PARSER.print_help()
         print("\nMissing input argument.\n")
@@ -124,8 +345,12 @@ if __name__ == '__main__':
         ROOT_DIR = ARGS.directory
         MKV_FILES = ROOT_DIR.glob('**/*.mkv')
     elif ARGS.directory_flat:
-        ROOT_DIR = ARGS.directory
-        PARSER.print_help()
-        print("\nNot yet implemented.\n")
-        sys.exit(1)
-    main()
+        ROOT_DIR = ARGS.directory_flat
+        MKV_FILES = ROOT_DIR.glob('*.mkv')
+    
+    JOURNAL = None if ARGS.no_journal else Journal(ROOT_DIR / JOURNAL_NAME)
+    try:
+        main()
+    finally:
+        if JOURNAL:
+            JOURNAL.close()
@@ -5,9 +5,30 @@ This script parses macOS kernel panic logs and attempts to clean up and shorted
 them to be a little more readable.
 """
 
+import os
+import re
+import csv
+import glob
 import json
+import hashlib
 import pathlib
 import argparse
+from concurrent.futures import ProcessPoolExecutor
+
+# how much of the panic log to read at a time (in bytes)
+CHUNK_SIZE = 1024 * 1024
+# a JSON string (group 1 is the closing quote, missing if the string runs past
+# the end of the chunk) or a JSON structural character.
+TOKEN_RE = re.compile(rb'"(?:[^"\\]|\\.)*(")?|[{}\[\],:]')
+# same as TOKEN_RE without the separators, used to get past skipped values
+# where only the nesting matters.
+SKIP_RE = re.compile(rb'"(?:[^"\\]|\\.)*(")?|[{}\[\]]')
+SKIP_KEYS = ['binaryImages', 'processByPid']
+# keys the panic string has been stored under across macOS versions.
+PANIC_KEYS = ['panicString', 'macOSPanicString']
+PANIC_SUFFIXES = ('.panic', '.ips')
+# addresses and counters that change between otherwise identical panics.
+SIGNATURE_RE = re.compile(r'0x[0-9a-fA-F]+|\b\d+\b')
 
 def value_converter(dv):
     if isinstance(dv, dict):
@@ -23,34 +44,243 @@ def convert_nested_dict(dict_data):
         new_dict[dkey] = value_converter(dvalue)
     return new_dict
 
-parser = argparse.ArgumentParser()
-parser.add_argument('panic_log', help="Path to panic log to parse.")
-args = parser.parse_args()
+def arg_parser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('panic_logs', nargs='+',
+        help="Panic logs, directories of panic logs or globs to clean.")
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count(),
+        help="Number of panic logs to clean at once.")
+    parser.add_argument('-f', '--force', action='store_true',
+        help="Clean panic logs even if their CLEAN- file is up to date. A "
+        "single log is always cleaned.")
+    parser.add_argument('-i', '--index', type=pathlib.Path,
+        default=pathlib.Path('PANIC-INDEX.csv'),
+        help="Where to write the index of panic signatures when more than "
+        "one panic log is cleaned. Defaults to ./PANIC-INDEX.csv")
+    return parser.parse_args()
+
+def find_panic_logs(paths):
+    """
+    Expands files, directories and globs into the panic logs to clean. CLEAN-
+    files are left out so a directory can be cleaned more than once.
+    """
+    seen = set()
+    for arg in paths:
+        matches = glob.glob(arg, recursive=True) or [arg]
+        for match in map(pathlib.Path, matches):
+            if match.is_dir():
+                found = sorted(f for f in match.rglob('*')
+                    if f.suffix in PANIC_SUFFIXES and f.is_file())
+            else:
+                found = [match]
+            for panic_log in found:
+                if panic_log.name.startswith('CLEAN-'): continue
+                if panic_log in seen: continue
+                seen.add(panic_log)
+                yield panic_log
+
+def panic_signature(panic_string):
+    """
+    Returns (signature, normalized first line) for a panic string. addresses
+    and numbers are masked so the same panic groups together across machines.
+    """
+    first_line = panic_string.strip().split('\n', 1)[0]
+    normalized = SIGNATURE_RE.sub('#', first_line)
+    digest = hashlib.sha1(normalized.encode('utf-8')).hexdigest()[:12]
+    return digest, normalized
+
+def iter_top_level(fh, skip_keys):
+    """
+    Streams the top level JSON object from fh and yields (key, raw value bytes)
+    for each key that isn't in skip_keys. if skip_keys is callable it's called
+    with each key and the key is skipped when it returns True. the file is
+    read in chunks and only the structure is tokenized, skipped values are
+    scanned past without being kept or parsed.
+    """
+    depth = 0
+    state = 'key'
+    key = None
+    keep = False
+    value_parts = []
+    value_start = 0
+    carry = b''
+    while True:
+        chunk = fh.read(CHUNK_SIZE)
+        data = carry + chunk
+        carry = b''
+        cut = len(data)
+        pos = 0
+        while True:
+            skipping = state == 'value' and not keep and depth > 1
+            match = (SKIP_RE if skipping else TOKEN_RE).search(data, pos)
+            if match is None:
+                break
+            pos = match.end()
+            token = match.group()
+            if token[:1] == b'"' and match.group(1) is None:
+                # string runs into the next chunk, read more and try again.
+                if not chunk:
+                    raise ValueError("Unterminated string in panic log.")
+                cut = match.start()
+                carry = data[cut:]
+                break
+            if depth == 1:
+                if state == 'key' and token[:1] == b'"':
+                    key = json.loads(token)
+                    state = 'colon'
+                    continue
+                if state == 'colon' and token == b':':
+                    state = 'value'
+                    if callable(skip_keys):
+                        keep = not skip_keys(key)
+                    else:
+                        keep = key not in skip_keys
+                    value_start = pos
+                    continue
+                if state == 'value' and token in (b',', b'}'):
+                    if keep:
+                        value_parts.append(data[value_start:match.start()])
+                        yield key, b''.join(value_parts)
+                        value_parts = []
+                    state = 'key'
+                    if token == b'}':
+                        return
+                    continue
+            if token in (b'{', b'['):
+                depth += 1
+            elif token in (b'}', b']'):
+                depth -= 1
+        if state == 'value' and keep:
+            value_parts.append(data[value_start:cut])
+        # the carried bytes start the next chunk.
+        value_start = 0
+        if not chunk:
+            raise ValueError("Panic log ended before the JSON did.")
 
-panic_log = pathlib.Path(args.panic_log)
-panic_log_dir = panic_log.parent
-panic_log_cleaned = panic_log_dir / f"CLEAN-{panic_log.name}"
+def read_summary(panic_log):
+    """
+    Pulls only the OS build and panic string out of a panic log. stops
+    reading once both have been found.
+    """
+    summary = {'build': None, 'panic': None}
+    wanted = set(PANIC_KEYS + ['build'])
+    with open(panic_log, 'rb') as fh:
+        panic_meta = json.loads(fh.readline() or b'{}')
+        summary['build'] = panic_meta.get('os_version')
+        for key, raw_value in iter_top_level(fh, lambda k: k not in wanted):
+            wanted.discard(key)
+            if key == 'build':
+                summary['build'] = json.loads(raw_value)
+            elif summary['panic'] is None:
+                summary['panic'] = json.loads(raw_value)
+            if 'build' not in wanted and summary['panic'] is not None:
+                break
+    return summary
 
-with open(panic_log, 'r', encoding='utf-8') as fp:
-    file_lines = fp.readlines()
+def clean_panic(panic_log, force=False):
+    """
+    Writes the CLEAN- version of panic_log next to it and returns a summary of
+    the panic for the index. logs with an up to date CLEAN- file are only
+    summarized.
+    """
+    panic_log_cleaned = panic_log.parent / f"CLEAN-{panic_log.name}"
+    summary = {'file': str(panic_log), 'cleaned': None, 'error': None,
+        'build': None, 'panic': None}
+    tmp_cleaned = panic_log_cleaned.with_name(f".{panic_log_cleaned.name}.tmp")
+    try:
+        if not force and panic_log_cleaned.exists() and \
+            panic_log_cleaned.stat().st_mtime > panic_log.stat().st_mtime:
+            summary.update(read_summary(panic_log))
+            return summary
+        
+        with open(panic_log, 'rb') as fh, \
+            open(tmp_cleaned, 'w', encoding='utf-8') as fp:
+            # the first line is the panic's metadata, the JSON body starts
+            # after it.
+            panic_meta = json.loads(fh.readline() or b'{}')
+            summary['build'] = panic_meta.get('os_version')
+            # nested JSON strings are only expanded for the keys that get
+            # written, and each key is written as soon as it's parsed.
+            for key, raw_value in iter_top_level(fh, SKIP_KEYS):
+                value = value_converter(json.loads(raw_value))
+                if key == 'build':
+                    summary['build'] = value
+                elif key in PANIC_KEYS and summary['panic'] is None:
+                    summary['panic'] = value
+                if isinstance(value, dict):
+                    fp.write(f"{key}: ")
+                    fp.write(json.dumps(value, indent=4))
+                else:
+                    fp.write(f"{key}: {value}")
+                fp.write("\n\n")
+        os.replace(tmp_cleaned, panic_log_cleaned)
+        summary['cleaned'] = str(panic_log_cleaned)
+    except (OSError, ValueError) as e:
+        # one bad report shouldn't stop the rest of the batch.
+        summary['error'] = f"{type(e).__name__}: {e}"
+        try:
+            os.remove(tmp_cleaned)
+        except OSError:
+            pass
+    return summary
+
+def write_index(index_path, summaries):
+    """
+    Groups the panics by signature and writes one row per signature, most
+    common first.
+    """
+    signatures = {}
+    for summary in summaries:
+        if summary['error']: continue
+        panic_string = summary['panic'] if isinstance(summary['panic'], str) \
+            else "(no panic string)"
+        digest, normalized = panic_signature(panic_string)
+        sig = signatures.setdefault(digest, {'panic': normalized, 'count': 0,
+            'builds': set(), 'files': []})
+        sig['count'] += 1
+        sig['builds'].add(str(summary['build'] or 'unknown'))
+        sig['files'].append(summary['file'])
+    
+    with open(index_path, 'w', encoding='utf-8', newline='') as fp:
+        writer = csv.writer(fp)
+        writer.writerow(['signature', 'count', 'builds', 'panic', 'files'])
+        for digest, sig in sorted(signatures.items(),
+            key=lambda s: (-s[1]['count'], s[0])):
+            writer.writerow([digest, sig['count'],
+                '; '.join(sorted(sig['builds'])), sig['panic'],
+                '; '.join(sig['files'])])
+    return len(signatures)
 
-panic_meta = file_lines[0]
-panic_data = file_lines[1:]
-panic_data_str = '\n'.join(panic_data)
-data = json.loads(panic_data_str)
-expanded_data = value_converter(data)
 
-skip_keys = ['binaryImages', 'processByPid']
-with open(panic_log_cleaned, 'w', encoding='utf-8') as fp:
+if __name__ == '__main__':
+    args = arg_parser()
+    panic_logs = list(find_panic_logs(args.panic_logs))
+    if not panic_logs:
+        print("No panic logs found.")
+        raise SystemExit(1)
+    
+    if len(panic_logs) == 1:
+        # a single log doesn't need a pool or an index, and it's always
+        # cleaned since that's the only reason to pass it.
+        summaries = [clean_panic(panic_logs[0], force=True)]
+    else:
+        with ProcessPoolExecutor(max_workers=args.jobs) as pool:
+            summaries = list(pool.map(clean_panic, panic_logs,
+                [args.force] * len(panic_logs), chunksize=8))
+    
+    cleaned = [s for s in summaries if s['cleaned']]
+    errors = [s for s in summaries if s['error']]
+    for summary in errors:
+        print(f"Failed to clean {summary['file']}: {summary['error']}")
     
-    for key, value in expanded_data.items():
-        if key in skip_keys: continue
-        if isinstance(value, dict):
-            fp.write(f"{key}: ")
-            fp.write(json.dumps(value, indent=4))
-        else:
-            fp.write(f"{key}: {value}")
-        fp.write("\n\n")
-
-print("Saved clean file to:")
-print(f"\t{panic_log_cleaned}")
+    if len(panic_logs) == 1:
+        if cleaned:
+            print("Saved clean file to:")
+            print(f"\t{cleaned[0]['cleaned']}")
+    else:
+        sig_count = write_index(args.index, summaries)
+        skipped = len(summaries) - len(cleaned) - len(errors)
+        print(f"Cleaned {len(cleaned)}, skipped {skipped} up to date and "
+            f"{len(errors)} failed of {len(summaries)} panic logs.")
+        print(f"Saved {sig_count} panic signatures to:")
+        print(f"\t{args.index}")
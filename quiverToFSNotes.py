@@ -1,34 +1,55 @@
 #!/usr/bin/env python3
 import os
 import json
+import shlex
+import shutil
 import pathlib
+import argparse
+import subprocess
 from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor
 
 #
 # this script aims to convert Quiver's qvlibrary DB into an FSNotes
 # folder/bundle structure. this script only converts plain text, markdown, and
 # code cells. it doesn't attempt to convert LaTeX or Diagram cells.
 # 
-# NOTE: Update the qvlibrary and destination variables with your paths.
+# usage: quiverToFSNotes.py /path/to/Quiver.qvlibrary /path/to/destination
+# 
+# running it again with --sync only converts notes that were updated in Quiver
+# since the last run, and removes notes that were deleted in Quiver.
 # 
-# gl;hf not my fault if something breaks as it worked for me :shrug:
-#
-
-# the path to your Quiver.qvlibrary
-qvlibrary = pathlib.Path('')
-
-# the path to where you want this script to create all of the converted files.
 # i personally drop them into a temp `fsnotes` folder and manually moved my new
 # note folders into the apps FSNotes folder.
-destination = pathlib.Path('')
+# 
+# gl;hf not my fault if something breaks as it worked for me :shrug:
+#
 
 
 # characters that are bad for filesystem names
 # list pulled from https://helpdesk.egnyte.com/hc/en-us/articles/201637074-Unsupported-Characters-and-File-Types
 nono_characters = ["\\", "/", '"', ":", "<", ">", "|", "*", "?"]
+# str.translate table that swaps every nono character for a dash
+nono_table = str.maketrans({nono: '-' for nono in nono_characters})
 
+# the sync manifest saved in the destination folder
+MANIFEST_NAME = '.quiver_sync.json'
 
-def convert_notebook(qvnotebook):
+
+def arg_parser():
+    parser = argparse.ArgumentParser(
+        description="Converts a Quiver library into FSNotes folders and notes.")
+    parser.add_argument('qvlibrary', type=pathlib.Path,
+        help="The path to your Quiver.qvlibrary.")
+    parser.add_argument('destination', type=pathlib.Path,
+        help="The path to where the converted notes will be created.")
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count(),
+        help="How many notes to convert at the same time (%(default)s).")
+    parser.add_argument('-s', '--sync', action='store_true',
+        help="Only converts notes updated since the last run and removes deleted notes.")
+    return parser.parse_args()
+
+def convert_notebook(qvnotebook, destination):
     '''This function converts Quiver Notebooks into an FSNotes folder.'''
     # get the Quiver Notebook name and sanitize it
     qvnotebook_meta_path = qvnotebook / 'meta.json'
@@ -47,33 +68,13 @@ def read_file(fp):
 
 def sanitize_name(name):
     '''This function sanitizes names to be safe for file systems.'''
-    found_nono = False
-    sname = name
-    for nono in nono_characters:
-        if nono in sname:
-            sname = sname.replace(nono, '-')
-            found_nono = True
-    # this section will catch names that begin with a period as those would
-    # become hidden files or folders.
-    if sname.startswith('.'):
-        sname = sname[1:]
-        found_nono = True
-    # file names with a period at the end are bad for file systems according to
-    # Egnyte's documentation.
-    if sname.endswith('.'):
-        sname = sname[:-1]
-        found_nono = True
-    # file names that begin or end with a space are fucked.
-    if sname.startswith(' '):
-        sname = sname[1:]
-        found_nono = True
-    if sname.endswith(' '):
-        sname = sname[:-1]
-        found_nono = True
-    # keep looking through this function until no more nonos are found.
-    if found_nono is True:
-        sname = sanitize_name(sname)
-    return sname
+    # swap out all of the nono characters in one pass.
+    sname = name.translate(nono_table)
+    # names that begin with a period would become hidden files or folders,
+    # names with a period at the end are bad for file systems according to
+    # Egnyte's documentation, and names that begin or end with a space are
+    # fucked. strip all of them at once.
+    return sname.strip('. ')
 
 def convert_file(qvnote, new_note_folder):
     '''This function converts a Quiver note to an FSNote.'''
@@ -94,7 +95,6 @@ def convert_file(qvnote, new_note_folder):
         note_title = '-tag me-'
     
     cells = content_data.get('cells')
-    new_text = convert_cells(note_title, cells)
     
     # build the new note bundle path
     new_note_path = new_note_folder / f"{meta_data['uuid']}.textbundle"
@@ -103,11 +103,14 @@ def convert_file(qvnote, new_note_folder):
     
     new_note_path.mkdir(exist_ok=True)
     
-    write_file(nn_info_path, json.dumps(fsnotes_info, indent=4))
-    write_file(nn_text_path, new_text)
+    write_file(nn_info_path, FSNOTES_INFO_JSON)
+    with open(nn_text_path, 'w') as file:
+        write_cells(file, note_title, cells)
     
-    set_create_mod_dates(meta_data['created_at'], meta_data['updated_at'],
-        content_path, new_note_path)
+    # the dates are set for the whole notebook at once, see set_create_mod_dates
+    create_epoch, mod_epoch = note_epochs(meta_data['created_at'],
+        meta_data['updated_at'], content_path)
+    return new_note_path, create_epoch, mod_epoch
 
 def key_check(meta_data, content_data):
     # keys that i know about
@@ -123,45 +126,44 @@ def key_check(meta_data, content_data):
         print("!!! NEW CONTENT KEYS !!!")
         print(content_keys)
 
-def convert_cells(note_title, cells):
-    '''This function converts raw Quiver Note cells to Markdown.'''
+def write_cells(file, note_title, cells):
+    '''This function converts raw Quiver Note cells to Markdown, writing each
+    cell straight to the note's file instead of building the whole note in
+    memory.'''
     if cells is None:
         print(f"NO CELL DATA for note {note_title}")
-        return None
-    md_text_array = []
-    for cell in cells:
-        # setup empty code_lang variable so that if there isn't a
-        # coding_language, then nothing will be inserted.
-        code_lang = ''
+        cells = []
+    # add the title as a MD H1 header if it was found.
+    if note_title != '-tag me-':
+        file.write(f"# {note_title}\n\n")
+    for index, cell in enumerate(cells):
+        # separate the converted cells by newlines and a bar
+        if index:
+            file.write('\n\n---\n\n')
         # type - code, markdown, text
         # i really only care about code, as MD and text can be treated the same.
         cell_type = cell.get('type')
-        cell_language = cell.get('language')
         cell_data = cell.get('data')
         if cell_type == 'code':
-            if cell_language is not None:
-                # sets the coding language if it was found
-                code_lang = cell_language
+            # sets the coding language if it was found, otherwise nothing
+            # will be inserted.
+            cell_language = cell.get('language')
+            code_lang = '' if cell_language is None else cell_language
             # converts into a MD codeblock with a language tag
-            cell_data = f"""```{code_lang}\n{cell_data}\n```"""
-        md_text_array.append(cell_data)
-    # join all of the converted cells separating them by newlines and a bar
-    new_text = '\n\n---\n\n'.join(md_text_array)
+            file.write(f"""```{code_lang}\n{cell_data}\n```""")
+        else:
+            file.write(cell_data)
     # add a #missing_title tag if the note didn't have a title.
     if note_title == '-tag me-':
-        new_text = f"{new_text}\n\n#missing_title"
-    else:
-        # add the title as a MD H1 header if it was found.
-        new_text = f"# {note_title}\n\n{new_text}"
-    return new_text
+        file.write("\n\n#missing_title")
 
 def write_file(fp, data):
     with open(fp, 'w') as file:
         file.write(data)
 
-def set_create_mod_dates(create_epoch, mod_epoch, content_path, new_note_path):
-    '''This function sets the creation and modification date and time on the new
-    FSNotes note bundle to match the Quiver note's creation and mod date/time.'''
+def note_epochs(create_epoch, mod_epoch, content_path):
+    '''This function returns the creation and modification epochs for a note,
+    falling back to the Quiver file's dates if the note's look wrong.'''
     # epoch time for GMT 2000-01-01 00:00:00
     # this is to validate the timestamp is more likely to be real
     if create_epoch < 946684800:
@@ -170,6 +172,12 @@ def set_create_mod_dates(create_epoch, mod_epoch, content_path, new_note_path):
     if mod_epoch < 946684800:
         # fall back to reading the files mod timestamp, cast to Int
         mod_epoch = int(content_path.stat().st_mtime)
+    return create_epoch, mod_epoch
+
+def set_create_mod_dates(notes):
+    '''This function sets the creation and modification date and time on a
+    notebook's new FSNotes note bundles to match the Quiver notes' creation and
+    mod date/time. notes is a list of (new_note_path, create_epoch, mod_epoch).'''
     # convert epoch time to the time format SetFile expects
     # NOTE: SetFile is deprecated, but as far as i've found it's the only _real_
     #       way to change the creation time of a file. using the `touch` 'method' or
@@ -179,12 +187,118 @@ def set_create_mod_dates(create_epoch, mod_epoch, content_path, new_note_path):
     #       e.g. current creation date is 2019-01-01 and new creation date is
     #       2019-08-31, only the SetFile method will work without dropping into
     #       Swift or Obj-C APIs.
-    create_str = datetime.fromtimestamp(create_epoch).strftime('%m/%d/%Y %H:%M')
-    # set the creation date
-    os.system(f'setfile -d "{create_str}" "{new_note_path}"')
-    # set the mod date
-    os.utime(new_note_path, (mod_epoch, mod_epoch))
+    # SetFile takes several files per date, so notes are grouped by their
+    # creation date and the whole notebook runs in one shell instead of a
+    # shell per note.
+    by_date = {}
+    for new_note_path, create_epoch, _ in notes:
+        create_str = datetime.fromtimestamp(create_epoch).strftime('%m/%d/%Y %H:%M')
+        by_date.setdefault(create_str, []).append(shlex.quote(str(new_note_path)))
+    if SETFILE:
+        # set the creation dates
+        script = '\n'.join(f'setfile -d {shlex.quote(create_str)} {" ".join(paths)}'
+            for create_str, paths in by_date.items())
+        subprocess.run(['/bin/sh'], input=script, text=True, check=False)
+    # set the mod dates
+    for new_note_path, _, mod_epoch in notes:
+        os.utime(new_note_path, (mod_epoch, mod_epoch))
+
+
+def read_manifest(destination):
+    '''This function reads the sync manifest, returning an empty one if there
+    isn't one yet.'''
+    manifest_path = destination / MANIFEST_NAME
+    if not manifest_path.is_file():
+        return {}
+    return read_file(manifest_path)
+
+def write_manifest(destination, manifest):
+    manifest_path = destination / MANIFEST_NAME
+    tmp_path = manifest_path.with_suffix('.tmp')
+    write_file(tmp_path, json.dumps(manifest))
+    os.replace(tmp_path, manifest_path)
 
+def remove_notes(folder, note_entries):
+    '''This function deletes the FSNotes bundles for notes deleted in Quiver.'''
+    for note_entry in note_entries:
+        bundle_path = pathlib.Path(folder, f"{note_entry['uuid']}.textbundle")
+        print(f"Removing {bundle_path}")
+        shutil.rmtree(bundle_path, ignore_errors=True)
+
+def sync_notebook(pool, qvnotebook, destination, entry):
+    '''This function converts a notebook's new and updated notes and removes
+    its deleted notes. entry is the notebook's manifest entry from the last
+    run (or None), and the updated entry is returned.
+    
+    the manifest keeps each note's meta.json mtime and updated_at. a note's
+    meta.json is only read when its mtime changed, and the notebook folder is
+    only listed when its mtime changed (notes were added or removed), so a
+    sync with no changes is just a stat per note.'''
+    entry = entry or {'mtime': None, 'meta_mtime': None, 'folder': None, 'notes': {}}
+    old_notes = entry['notes']
+    
+    # notebook meta changed (or it's new), which could mean it was renamed.
+    meta_mtime = (qvnotebook / 'meta.json').stat().st_mtime_ns
+    if meta_mtime != entry['meta_mtime']:
+        note_folder = convert_notebook(qvnotebook, destination)
+        old_folder = entry['folder']
+        if old_folder and old_folder != str(note_folder):
+            print(f"Notebook renamed, moving {old_folder} to {note_folder}")
+            try:
+                # note_folder was just created empty, which rename replaces.
+                os.rename(old_folder, note_folder)
+            except OSError:
+                # couldn't move it, so start this notebook over.
+                remove_notes(old_folder, old_notes.values())
+                old_notes = {}
+    else:
+        note_folder = pathlib.Path(entry['folder'])
+    
+    # only list the notebook folder if notes were added or removed.
+    dir_mtime = qvnotebook.stat().st_mtime_ns
+    if dir_mtime == entry['mtime']:
+        note_names = list(old_notes)
+    else:
+        note_names = [note.name for note in qvnotebook.glob('*.qvnote')]
+    
+    new_notes = {}
+    to_convert = []
+    for note_name in note_names:
+        note = qvnotebook / note_name
+        try:
+            note_meta_mtime = (note / 'meta.json').stat().st_mtime_ns
+        except FileNotFoundError:
+            continue
+        note_entry = old_notes.get(note_name)
+        if note_entry and note_entry['meta_mtime'] == note_meta_mtime:
+            new_notes[note_name] = note_entry
+            continue
+        meta_data = read_file(note / 'meta.json')
+        new_notes[note_name] = {
+            'uuid': meta_data['uuid'],
+            'updated_at': meta_data['updated_at'],
+            'meta_mtime': note_meta_mtime,
+        }
+        if note_entry and note_entry['updated_at'] == meta_data['updated_at']:
+            continue
+        to_convert.append(note)
+    
+    # notes that were deleted in Quiver
+    remove_notes(note_folder,
+        [n for name, n in old_notes.items() if name not in new_notes])
+    
+    if to_convert:
+        print(f"Converting {len(to_convert)} notes in {note_folder.name}")
+        converted = pool.map(convert_file, to_convert,
+            [note_folder] * len(to_convert), chunksize=32)
+        set_create_mod_dates(list(converted))
+    
+    return {
+        'mtime': dir_mtime,
+        'meta_mtime': meta_mtime,
+        'folder': str(note_folder),
+        'notes': new_notes,
+    }
 
 # as of 2021-08, all FSNotes contain the same info data.
 fsnotes_info = {
@@ -193,10 +307,38 @@ fsnotes_info = {
     "creatorIdentifier" : "co.fluder.fsnotes",
     "version" : 2
 }
+# every note gets the same info.json, so it's only serialized once.
+FSNOTES_INFO_JSON = json.dumps(fsnotes_info, indent=4)
 
+# SetFile only ships with the Xcode command line tools.
+SETFILE = shutil.which('setfile')
 
-# loop through each notebook and convert the notebook and all of its notes to FSNotes.
-for qvnotebook in list(qvlibrary.glob('*.qvnotebook')):
-    note_folder = convert_notebook(qvnotebook)
-    for note in list(qvnotebook.glob('*.qvnote')):
-        convert_file(note, note_folder)
+
+if __name__ == '__main__':
+    args = arg_parser()
+    if not SETFILE:
+        print("setfile not found, creation dates won't be set.")
+    
+    # a full conversion starts with an empty manifest so every note is
+    # converted, and saves the manifest for the next --sync.
+    old_manifest = read_manifest(args.destination) if args.sync else {}
+    manifest = {}
+    
+    # loop through each notebook and convert the notebook and all of its notes
+    # to FSNotes, spreading the notes across a pool of processes.
+    with ProcessPoolExecutor(max_workers=args.jobs) as pool:
+        for qvnotebook in list(args.qvlibrary.glob('*.qvnotebook')):
+            manifest[qvnotebook.name] = sync_notebook(pool, qvnotebook,
+                args.destination, old_manifest.get(qvnotebook.name))
+    
+    # notebooks that were deleted in Quiver
+    for qvnotebook_name, entry in old_manifest.items():
+        if qvnotebook_name in manifest: continue
+        remove_notes(entry['folder'], entry['notes'].values())
+        try:
+            os.rmdir(entry['folder'])
+        except OSError:
+            # not empty, something other than this script put files there.
+            pass
+    
+    write_manifest(args.destination, manifest)